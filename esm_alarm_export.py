@@ -3,6 +3,7 @@
 import argparse
 import base64
 import csv
+import functools
 import json
 import logging
 import os
@@ -13,8 +14,18 @@ import time
 import urllib.parse as urlparse
 from configparser import ConfigParser, NoSectionError
 from datetime import datetime
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry  # allowed_methods needs urllib3 >= 1.26
 requests.packages.urllib3.disable_warnings()
 
+# orjson parses large alarm pages several times faster when available.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 
 class Config(object):
     """
@@ -25,13 +36,16 @@ class Config(object):
      - esmpass
     """
     CONFIG = None
+    _PARSED_CACHE = {}
 
     @classmethod
     def find_ini(cls):
         """
         Attempt to locate a mfe_saw.ini file
+
+        Parsed files are cached on their absolute paths and mtimes so
+        another Config in the same process skips reparsing unchanged files.
         """
-        config = ConfigParser()
         module_dir = os.path.dirname(sys.modules[__name__].__file__)
 
         if 'APPDATA' in os.environ:
@@ -46,7 +60,20 @@ class Config(object):
         paths = [os.path.join(module_dir, '.mfe_saw.ini'), '.mfe_saw.ini']
         if conf_path is not None:
             paths.insert(1, os.path.join(conf_path, '.mfe_saw.ini'))
-        config.read(paths)
+
+        key = []
+        for path in paths:
+            try:
+                key.append((os.path.abspath(path), os.stat(path).st_mtime))
+            except OSError:
+                continue
+        key = tuple(key)
+
+        config = cls._PARSED_CACHE.get(key)
+        if config is None:
+            config = ConfigParser()
+            config.read(paths)
+            cls._PARSED_CACHE[key] = config
         cls.CONFIG = config
 
     def __init__(self, **kwargs):
@@ -61,11 +88,12 @@ class Config(object):
 
     def _find_envs(self):
         """
-        Builds a dict with env variables set starting with 'ESM'.
+        Builds a dict with env variables set starting with 'ESM',
+        keyed in lower case to match the ini options.
         """
-        self._envs = {self._kenv: self._venv
-                      for self._kenv, self._venv in os.environ.items()
-                      if self._kenv.startswith('ESM')}
+        self._envs = {key.lower(): val
+                      for key, val in os.environ.items()
+                      if key.startswith('ESM')}
 
     def _init_config(self):
         """
@@ -90,9 +118,6 @@ class Config(object):
             print("Section [esm] not found in mfe_saw.ini")
 
         # any envs overwrite the ini values
-        if self._envs:
-            self._envs = {self._key.lower(): self._val
-                            for self._key, self._val in self._envs.items()}
         self.__dict__.update(self._envs)
 
 
@@ -100,33 +125,63 @@ class ESM(object):
     """
     """
 
-    def __init__(self, hostname, username, password):
+    def __init__(self, hostname, username, password, timeout=(5, 120)):
         """
+        Args:
+            timeout (tuple): (connect, read) socket timeouts in seconds so
+                             a stalled ESM can't hang an export. Read
+                             timeouts are not retried and end the export
+                             after a single wait.
         """
         self._host = hostname
         self._user = username
         self._passwd = password
+        self._timeout = timeout
 
         self._base_url = 'https://{}/rs/esm/'.format(self._host)
         self._int_url = 'https://{}/ess'.format(self._host)
 
-        self._v9_creds = '{}:{}'.format(self._user, self._passwd)
-        self._v9_b64_creds = base64.b64encode(self._v9_creds.encode('utf-8'))
-
-        self._v10_b64_user = base64.b64encode(self._user.encode('utf-8')).decode()
-        self._v10_b64_passwd = base64.b64encode(self._passwd.encode('utf-8')).decode()
-        self._v10_params = {"username": self._v10_b64_user,
-                            "password": self._v10_b64_passwd,
-                            "locale": "en_US",
-                            "os": "Win32"}
         self._headers = {'Content-Type': 'application/json'}
 
+        # One keep-alive connection is reused for every call to the ESM
+        # so paged exports don't pay for a new TLS handshake per request.
+        # Transient server errors are retried with exponential backoff.
+        # Read errors are not retried so a POST the ESM may already have
+        # accepted is never sent twice.
+        retry = Retry(total=5, read=False, backoff_factor=1.0,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=frozenset(['POST', 'DELETE']),
+                      respect_retry_after_header=True)
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(max_retries=retry,
+                                                    pool_connections=1,
+                                                    pool_maxsize=4))
+
+    @functools.cached_property
+    def _v9_b64_creds(self):
+        creds = '{}:{}'.format(self._user, self._passwd)
+        return base64.b64encode(creds.encode('utf-8')).decode('utf-8')
+
+    @functools.cached_property
+    def _v10_b64_user(self):
+        return base64.b64encode(self._user.encode('utf-8')).decode()
+
+    @functools.cached_property
+    def _v10_b64_passwd(self):
+        return base64.b64encode(self._passwd.encode('utf-8')).decode()
+
+    @functools.cached_property
+    def _v10_params(self):
+        return {"username": self._v10_b64_user,
+                "password": self._v10_b64_passwd,
+                "locale": "en_US",
+                "os": "Win32"}
+
     def login(self):
         """
         Log into the ESM
         """
-        self._headers = {'Authorization': 'Basic ' +
-                         self._v9_b64_creds.decode('utf-8'),
+        self._headers = {'Authorization': 'Basic ' + self._v9_b64_creds,
                          'Content-Type': 'application/json'}
         self._method = 'login'
         self._data = self._v10_params
@@ -150,7 +205,8 @@ class ESM(object):
         """
         """
         self._url = self._base_url + 'logout'
-        self._resp = requests.delete(self._url, headers=self._headers, verify=False)
+        self._resp = self._session.delete(self._url, headers=self._headers,
+                                          verify=False, timeout=self._timeout)
                 
     def time(self):
         """
@@ -185,6 +241,8 @@ class ESM(object):
         self.end = end
         self._method = 'alarmGetTriggeredAlarms?triggeredTimeRange=CUSTOM&customStart={}&customEnd={}&assignedUser{}&pageSize=0&pageNumber=0'.format(self.start, self.end, self.user)
         self._resp = self.post(self._method, headers=self._headers)
+        if self._resp is None:
+            raise RuntimeError('ESM returned no alarm list')
         return self._resp
 
         
@@ -192,52 +250,49 @@ class ESM(object):
              headers=None, verify=False):
         """
         """
-        self._method = method
-        self._data = data
-        self._callback = callback
-        self._headers = headers
-        self._raw = raw
-        self._verify = verify
-
-        if not self._method:
+        if not method:
             raise ValueError("Method must not be None")
 
-        self._url = self._base_url + self._method
-        if self._method == self._method.upper():
-            self._url = self._int_url
-            self._data = self._format_params(self._method, **self._data)
+        is_internal = method.isupper()
+        if is_internal:
+            url = self._int_url
+            data = self._format_params(method, **data)
         else:
-            self._url = self._base_url + self._method
-            if self._data:
-                self._data = json.dumps(self._data)
-                
-        self._resp = self._post(self._url, data=self._data,
-                                headers=self._headers, verify=self._verify)
+            url = self._base_url + method
+            if data:
+                data = json.dumps(data)
 
-        if self._raw:
-            return self._resp
+        resp = self._post(url, data=data, headers=headers, verify=verify)
 
+        if raw:
+            return resp
 
-        while self._resp.status_code == 500:
-            self._resp = self._post(self._url, data=self._data,
-                                headers=self._headers, verify=self._verify)
-            
-        if 200 <= self._resp.status_code <= 300:
+        if 200 <= resp.status_code <= 300:
+            # Decode through resp.text when the response declares a charset,
+            # as resp.json() does. Undecodable bodies fall back to the text.
             try:
-                self._resp = self._resp.json()
-                self._resp = self._resp.get('return')
-            except json.decoder.JSONDecodeError:
-                self._resp = self._resp.text
-            if self._method == self._method.upper():
-                self._resp = self._format_resp(self._resp)
-            if self._callback:
-                self._resp = self._callback(self._resp)
-            return self._resp
+                resp_json = _loads(resp.text if resp.encoding
+                                   else resp.content)
+            except ValueError:
+                resp = resp.text
+            else:
+                if (not isinstance(resp_json, dict)
+                        or 'return' not in resp_json):
+                    raise RuntimeError(
+                        'ESM returned no data: {}'.format(resp_json))
+                resp = resp_json['return']
+            if is_internal:
+                resp = self._format_resp(resp)
+            if callback:
+                resp = callback(resp)
+            return resp
+
+        raise RuntimeError('ESM returned HTTP {} for {}: {}'.format(
+            resp.status_code, method, resp.text))
             
 
            
-    @staticmethod
-    def _post(url, data=None, headers=None, verify=False):
+    def _post(self, url, data=None, headers=None, verify=False):
         """
         Method that actually kicks off the HTTP client.
 
@@ -251,9 +306,21 @@ class ESM(object):
         Returns:
             Requests Response object
         """
+        started = time.time()
         try:
-            return requests.post(url, data=data, headers=headers,
-                                 verify=verify)
+            return self._session.post(url, data=data, headers=headers,
+                                      verify=verify, timeout=self._timeout)
+
+        # Read timeouts arrive here directly since the Retry policy doesn't
+        # retry read errors. Connect timeouts land here once retries run out.
+        except requests.exceptions.Timeout:
+            print("ESM timed out after {:.1f}s: {}".format(
+                time.time() - started, url))
+            sys.exit(1)
+
+        except requests.exceptions.RetryError:
+            print("ESM kept returning server errors, giving up: {}".format(url))
+            sys.exit(1)
 
         except requests.exceptions.ConnectionError:
             print("Unable to connect to ESM: {}".format(url))
@@ -265,103 +332,101 @@ class ESM(object):
         Format API call
         """
 
-        params = {key: val
-                  for key, val in params.items() if val is not None}
-
         params = '%14'.join([key + '%13' + val + '%13'
-                             for (key, val) in params.items()])
+                             for (key, val) in params.items()
+                             if val is not None])
         if params:
-            params = 'Request=API%13' + cmd + '%13%14' + params + '%14'
-        else:
-            params = 'Request=API%13' + cmd + '%13%14'
-        return params
+            return 'Request=API%13' + cmd + '%13%14' + params + '%14'
+        return 'Request=API%13' + cmd + '%13%14'
 
     @staticmethod
     def _format_resp(resp):
         """
         Format API response
         """
-        resp = re.search('Response=(.*)', resp).group(1)
-        resp = resp.replace('%14', ' ')
-        pairs = resp.split()
+        # Like the old 'Response=(.*)' regex, stop at the end of the line.
+        resp = resp.partition('Response=')[2].partition('\n')[0].strip()
         formatted = {}
-        for pair in pairs:
-            pair = pair.replace('%13', ' ')
-            pair = pair.split()
-            key = pair[0]
+        for pair in resp.split('%14'):
+            if not pair:
+                continue
+            key, _, value = pair.partition('%13')
+            value = value.partition('%13')[0]
             if key == 'ITEMS':
-                value = dehexify(pair[-1])
+                value = dehexify(value)
             else:
-                value = urlparse.unquote(pair[-1])
+                value = urlparse.unquote(value)
             formatted[key] = value
         return formatted
 
 
+# Escaped commas, newlines and carriage returns are left alone so they
+# can't be confused with the field and row separators in ITEMS. UTF-8
+# multi-byte sequences never contain these bytes.
+_PCT_RE = re.compile(r'(?:%(?!2[Cc]|0[AaDd])[0-9A-Fa-f]{2})+')
+
+
+def _unquote_run(match):
+    """
+    Decode a run of percent escapes as UTF-8, like urlparse.unquote does.
+    """
+    run = match.group().replace('%', '')
+    return bytes.fromhex(run).decode('utf-8', 'replace')
+
+
+# Control characters the ESM uses as separators inside ITEMS.
+_HEXEN_TABLE = str.maketrans({
+    '\x1c': ',',  # Replacing File Separator with a comma.
+    '\x11': ',',  # Replacing Device Control 1 with a comma.
+    '\x12': '\n',  # Replacing Device Control 2 with a new line.
+})
+
+
 def dehexify(data):
     """
     Decode hex/url data
+
+    Percent escapes are decoded first so that %11 and %12 become the
+    control characters handled by the translate table. %2C, %0A and %0D
+    stay escaped.
     """
-    hexen = {
-        '\x1c': ',',  # Replacing Device Control 1 with a comma.
-        '\x11': ',',  # Replacing Device Control 2 with a new line.
-        '\x12': '\n',  # Space
-        '\x22': '"',  # Double Quotes
-        '\x23': '#',  # Number Symbol
-        '\x27': '\'',  # Single Quote
-        '\x28': '(',  # Open Parenthesis
-        '\x29': ')',  # Close Parenthesis
-        '\x2b': '+',  # Plus Symbol
-        '\x2d': '-',  # Hyphen Symbol
-        '\x2e': '.',  # Period, dot, or full stop.
-        '\x2f': '/',  # Forward Slash or divide symbol.
-        '\x7c': '|',  # Vertical bar or pipe.
-    }
-
-    uri = {
-        '%11': ',',  # Replacing Device Control 1 with a comma.
-        '%12': '\n',  # Replacing Device Control 2 with a new line.
-        '%20': ' ',  # Space
-        '%22': '"',  # Double Quotes
-        '%23': '#',  # Number Symbol
-        '%27': '\'',  # Single Quote
-        '%28': '(',  # Open Parenthesis
-        '%29': ')',  # Close Parenthesis
-        '%2B': '+',  # Plus Symbol
-        '%2D': '-',  # Hyphen Symbol
-        '%2E': '.',  # Period, dot, or full stop.
-        '%2F': '/',  # Forward Slash or divide symbol.
-        '%3A': ':',  # Colon
-        '%7C': '|',  # Vertical bar or pipe.
-    }
-
-    for (enc, dec) in hexen.items():
-        data = data.replace(enc, dec)
-
-    for (enc, dec) in uri.items():
-        data = data.replace(enc, dec)
-
-    return data
-   
+    data = _PCT_RE.sub(_unquote_run, data)
+    return data.translate(_HEXEN_TABLE)
+
 def convert_date(d):
-    return '{}-{}-{}T{}.000Z'.format(d[6:10], d[0:2], d[3:5], d[11:19])
-   
+    """
+    Convert an ESM 'MM/DD/YYYY HH:MM:SS' date to the ISO format the API
+    expects. Raises ValueError if the ESM changes its date format.
+    """
+    return datetime.strptime(d, '%m/%d/%Y %H:%M:%S').strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def iter_alarm_pages(esm, user, start, end):
+    """
+    Yield pages of triggered alarms, newest first, until a short page.
+    """
+    alarms = esm.export_alarms(user=user, start=start, end=end)
+    yield alarms
+    while len(alarms) == 500:
+        try:
+            end = convert_date(alarms[499]['triggeredDate'])
+        except ValueError as err:
+            raise RuntimeError('Cannot page past {!r}: {}'.format(
+                alarms[499]['triggeredDate'], err)) from err
+        alarms = esm.export_alarms(user=user, start=start, end=end)
+        yield alarms
+
+
 def main():
     config = Config()
-    try:
-        host = config.esmhost
-    except AttributeError:
-        print('Cannot find esmhost key in .mfe_saw.ini')
-        sys.exit(0)
-    try:        
-        username = config.esmuser
-    except AttributeError:
-        print('Cannot find esmuser key in .mfe_saw.ini')
-        sys.exit(0)
-    try:        
-        passwd = config.esmpass
-    except AttributeError:
-        print('Cannot find esmpass key in .mfe_saw.ini')
-        sys.exit(0)
+    for key in ('esmhost', 'esmuser', 'esmpass'):
+        if getattr(config, key, None) is None:
+            print('Cannot find {} key in .mfe_saw.ini'.format(key))
+            sys.exit(0)
+    host = config.esmhost
+    username = config.esmuser
+    passwd = config.esmpass
         
     helpdoc = '''\
     usage: esm_export_alarms -s [start-time] -e [end-time] 
@@ -399,26 +464,30 @@ def main():
     esm = ESM(host, username, passwd)
     esm.login()
     
-    full_list = []
-    alarms = esm.export_alarms(user='NGCP', start=start, end=end)
-    full_list.extend(alarms)
-    
-    while len(alarms) == 500:
-        end = convert_date(alarms[499]['triggeredDate'])
-        alarms = esm.export_alarms(user='NGCP', start=start, end=end)
-        full_list.extend(alarms)
-    full_list = sorted(full_list, key=lambda d: d['id']['value'])        
-    print('Alarm ID,Date,Summary,Details,Assignee,Ack Date,Ack User')
-    for alarm in full_list:
-        data = [str(alarm['id']['value']), 
-                str(alarm['triggeredDate']),
-                str(alarm['summary']),
-                str(alarm['alarmName']),
-                str(alarm['assignee']),
-                str(alarm['acknowledgedUsername']),
-                str(alarm['acknowledgedDate'])
-                ]
-        print(','.join(data))
+    # Only the output columns are kept so each page's full alarm dicts can
+    # be freed once it is consumed. Pages arrive newest first, so rows are
+    # still held until the end to print them in id order. Pages share the
+    # boundary timestamp so rows are keyed on id.
+    row_of = itemgetter('triggeredDate', 'summary', 'alarmName', 'assignee',
+                        'acknowledgedUsername', 'acknowledgedDate')
+    rows_by_id = {}
+    try:
+        for alarms in iter_alarm_pages(esm, 'NGCP', start, end):
+            for alarm in alarms:
+                alarm_id = alarm['id']['value']
+                if alarm_id not in rows_by_id:
+                    rows_by_id[alarm_id] = tuple(
+                        map(str, (alarm_id,) + row_of(alarm)))
+    except RuntimeError as err:
+        logging.warning("%s, exporting the alarms retrieved so far", err)
+
+    # csv quotes summaries and names that contain commas or newlines.
+    # Fields are str()'d beforehand so None still prints as 'None'.
+    writer = csv.writer(sys.stdout, quoting=csv.QUOTE_MINIMAL,
+                        lineterminator='\n')
+    writer.writerow(['Alarm ID', 'Date', 'Summary', 'Details', 'Assignee',
+                     'Ack Date', 'Ack User'])
+    writer.writerows(rows_by_id[alarm_id] for alarm_id in sorted(rows_by_id))
     esm.logout()
     
 if __name__ == "__main__":